@@ -1,21 +1,203 @@
-import traceback
+import argparse
+import logging
 import base64
-import re
+from pathlib import Path
+from copy import deepcopy
+from dataclasses import dataclass, field
+from functools import lru_cache
 from io import BytesIO
-from bs4 import BeautifulSoup, Tag
+from xml.sax.saxutils import escape, quoteattr
+import lxml.html
+import requests
+from lxml.html import HtmlElement
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from PIL import Image
 from docx import Document
 from docx.table import _Cell
 from docx.text.paragraph import Paragraph
-from docx.text.run import Run
-from docx.shared import RGBColor, Inches
+from docx.shared import Inches
 from docx.enum.text import WD_ALIGN_PARAGRAPH
-from docx.enum.dml import MSO_THEME_COLOR_INDEX
 from docx.opc.constants import RELATIONSHIP_TYPE
-from docx.oxml.shared import OxmlElement, qn
+from docx.oxml import parse_xml
+from docx.oxml.ns import nsdecls
 from haggis.files.docx import list_number
 
-soup = None
+# Use the linear time re2 engine when it is installed
+try:
+    import re2 as re
+except ImportError:
+    import re
+
+_LOGGER = logging.getLogger(__name__)
+
+# Shared HTTP session, reuses connections for image downloads
+# The pool keeps connections per host for concurrent conversions,
+# failed connections and reads are retried twice with a short backoff
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=20,
+        max_retries=Retry(total=2, backoff_factor=0.2),
+    ),
+)
+# Maximum (width, height) of pictures added to the document
+_IMAGE_SIZE = (500, 400)
+# Images bigger than this are skipped, bounds the memory of the downloads
+_MAX_IMAGE_BYTES = 5_000_000
+
+
+# Run styles applied by inline html tags
+_STYLE_TAG_MAP = {
+    "b": "bold",
+    "strong": "bold",
+    "i": "italic",
+    "em": "italic",
+    "u": "underline",
+}
+
+# Xml templates for bookmarks and hyperlinks, parsed once per element
+# instead of building and appending each element through python-docx
+_BOOKMARK_RUN_XML = (
+    f"<w:r {nsdecls('w')}>{{text}}"
+    "<w:bookmarkStart w:id={id} w:name={name}/>"
+    "<w:bookmarkEnd w:id={id}/>"
+    "</w:r>"
+)
+# Hyperlink run formatting, like the theme color and underline set by Run.font
+_HYPERLINK_RPR_XML = (
+    '<w:color w:val="000000" w:themeColor="hyperlink"/><w:u w:val="single"/>'
+)
+# w:history just indicates Word should store the link history
+_INTERNAL_HYPERLINK_XML = (
+    f"<w:hyperlink {nsdecls('w')} w:anchor={{anchor}} w:history=\"1\">"
+    f'<w:r><w:rPr><w:rStyle w:val="Hyperlink"/>{_HYPERLINK_RPR_XML}</w:rPr>'
+    "<w:t>{text}</w:t></w:r>"
+    "</w:hyperlink>"
+)
+_HYPERLINK_XML = (
+    f"<w:hyperlink {nsdecls('w', 'r')} r:id={{r_id}}>"
+    f"<w:r><w:rPr>{_HYPERLINK_RPR_XML}</w:rPr>{{text}}</w:r>"
+    "</w:hyperlink>"
+)
+# Wrapper for a batch of text runs, the namespace declaration is built once
+_RUNS_XML = f"<w:p {nsdecls('w')}>{{runs}}</w:p>"
+# Run content for the characters which are not written as text
+_RUN_BREAKS = {"\t": "<w:tab/>", "\n": "<w:br/>", "\r": "<w:br/>"}
+
+# Heading levels by html heading tag
+_HEADING_LEVELS = {"h1": 1, "h2": 2, "h3": 3, "h4": 4, "h5": 5, "h6": 6}
+
+# Regular expression to match anchor ids greather 40 characters
+_ANCHOR_HREF_RE = re.compile(r"#[a-zA-Z0-9-]{41,}")
+# Bare line breaks between tags, these are not added as text
+_BARE_NEWLINES = frozenset(("\n", "\r"))
+# Tags holding block content, indentation between their child tags is not text
+_BLOCK_CONTAINERS = frozenset(("td", "th", "li", "div", "section", "blockquote"))
+# Children of an <li> which are not part of its inline content
+_LIST_BLOCK_TAGS = frozenset(("ol", "ul", "p", "blockquote", "table", *_HEADING_LEVELS))
+# Regular expression to extract the section id from 'jumptosection' onclick events
+_JUMP_RE = re.compile(r"jumptosection\('([a-zA-Z0-9-]+)'\);")
+# Regular expression to match a hex "#E92A0C" or "rgb(233, 42, 12)" color value
+_COLOR_RE = re.compile(
+    r"#?([0-9a-fA-F]{6})|rgba?\(\s*(\d{1,3})\s*,\s*(\d{1,3})\s*,\s*(\d{1,3})"
+)
+# Regular expression to match the "property: value" declarations of a style attribute
+_STYLE_RE = re.compile(r"\s*([\w-]+)\s*:\s*([^;]+?)\s*(?:;|$)")
+# Xml declaration of xhtml documents, lxml rejects it in unicode strings
+_XML_DECLARATION_RE = re.compile(r"^\s*<\?xml[^>]*\?>")
+# Charset of a <meta> tag or encoding of an xml declaration, libxml2 honours both
+_CHARSET_RE = re.compile(r"(?i)<meta[^>]*charset|<\?xml[^>]*encoding")
+# Byte order marks of UTF-8 and UTF-16, these also set the encoding
+_BOMS = (b"\xef\xbb\xbf", b"\xff\xfe", b"\xfe\xff")
+
+
+@dataclass
+class ConversionContext:
+    """
+    State of a single html to docx conversion, passed down to the tag processors
+    Keeping it out of module globals allows concurrent conversions
+    """
+
+    doc: Document
+    # Elements of the html document, indexed by their "id"
+    id_map: dict[str, HtmlElement] = field(default_factory=dict)
+    # HTTP session for image downloads
+    session: requests.Session = _SESSION
+    # Empty paragraph at the end of the body while converting, new blocks are
+    # inserted before it instead of being appended through the document
+    end: Paragraph = None
+
+
+def add_paragraph(ctx: ConversionContext, text: str = "", style=None) -> Paragraph:
+    """
+    Add a paragraph at the end of the document
+    Document.add_paragraph searches the body for <w:sectPr> on every call,
+    inserting before the `ctx.end` paragraph keeps each call O(1)
+    """
+    if ctx.end is None:
+        return ctx.doc.add_paragraph(text, style)
+    return ctx.end.insert_paragraph_before(text, style)
+
+
+def add_heading(ctx: ConversionContext, text: str, level: int) -> Paragraph:
+    """
+    Add a heading paragraph at the end of the document, like Document.add_heading
+    """
+    return add_paragraph(ctx, text, "Title" if level == 0 else f"Heading {level}")
+
+
+def build_id_map(html_root: HtmlElement) -> dict[str, HtmlElement]:
+    """
+    Index all elements with an "id" attribute for O(1) lookups by id.
+    The first element wins for duplicate ids, like a document wide search.
+    """
+    elements = {}
+    for element in html_root.xpath("//*[@id]"):
+        elements.setdefault(element.get("id"), element)
+    return elements
+
+
+def parse_html(html: str | bytes) -> HtmlElement:
+    """
+    Parse an html document into an lxml tree
+    Bytes are decoded by libxml2 with the encoding of their byte order mark
+    or charset declaration, and as UTF-8 when they have neither, libxml2
+    would otherwise assume ISO-8859-1
+    """
+    if isinstance(html, bytes):
+        if html.startswith(_BOMS) or _CHARSET_RE.search(html[:1024].decode("latin-1")):
+            return lxml.html.document_fromstring(html)
+        # Parsers can not be shared between threads, create one per document
+        parser = lxml.html.HTMLParser(encoding="utf-8")
+        return lxml.html.document_fromstring(html, parser=parser)
+    # The string is already decoded, the declared encoding does not apply
+    html = _XML_DECLARATION_RE.sub("", html.lstrip("\ufeff"), count=1)
+    return lxml.html.document_fromstring(html)
+
+
+def parse_html_file(path: str) -> HtmlElement:
+    """
+    Parse an html file into an lxml tree
+    The file is read in binary mode and parsed like parse_html does for bytes
+    """
+    return parse_html(Path(path).read_bytes())
+
+
+def _prepare_tree(html: str | bytes | HtmlElement) -> HtmlElement:
+    """
+    Parse `html` once and apply the anchor cleanups in place, like
+    check_anchor_id_length followed by add_href_anchor_tags.
+    The returned tree can be passed to html_to_docx directly, without
+    serializing and parsing the document again in between
+    """
+    if isinstance(html, (str, bytes)):
+        html = parse_html(html)
+    trim_anchor_ids(html)
+    add_jump_hrefs(html)
+    return html
 
 
 def check_anchor_id_length(html: str, article_id: int) -> str:
@@ -25,20 +207,26 @@ def check_anchor_id_length(html: str, article_id: int) -> str:
     from the end are trimmed.
     Returns the modified HTML as string
     """
-    soup_html = BeautifulSoup(html, "lxml")
+    html_root = parse_html(html)
+    trim_anchor_ids(html_root)
+    return lxml.html.tostring(html_root, encoding="unicode")
 
-    # Regular expression to match anchor ids greather 40 characters
-    anchor_href_pattern = r"#[a-zA-Z0-9-]{41,}"
 
+def trim_anchor_ids(html_root: HtmlElement) -> None:
+    """
+    Trim the ids longer than 40 characters, and the links to them, in place
+    """
     # Retrieve all <a> tags where href matches the regular expression and trim the id
-    anchor_tags = soup_html.body.find_all("a", href=re.compile(anchor_href_pattern))
+    anchor_tags = [
+        a for a in html_root.body.iter("a") if _ANCHOR_HREF_RE.search(a.get("href", ""))
+    ]
+    anchor_targets = build_id_map(html_root)
     for a in anchor_tags:
-        href_val = a["href"].split("#")[1]
-        anchor_target = soup_html.find(id=href_val)
-        if anchor_target:
-            anchor_target["id"] = f"{href_val[:40]}"
-            a["href"] = f"#{href_val[:40]}"
-    return str(soup_html)
+        href_val = a.get("href").split("#")[1]
+        anchor_target = anchor_targets.get(href_val)
+        if anchor_target is not None:
+            anchor_target.set("id", f"{href_val[:40]}")
+            a.set("href", f"#{href_val[:40]}")
 
 
 def add_href_anchor_tags(html):
@@ -47,97 +235,137 @@ def add_href_anchor_tags(html):
     with 'onclick' or 'ng-click' attributes
     Custom method to handle 'jumptosection' onclick events - document specific
     """
-    pattern_1 = r"(?<=jumptosection\(')([a-zA-Z0-9-]+)(?='\);)"
-    parsed_html = BeautifulSoup(html, "lxml")
+    parsed_html = parse_html(html)
+    add_jump_hrefs(parsed_html)
+    return lxml.html.tostring(parsed_html, encoding="unicode")
+
+
+def add_jump_hrefs(html_root: HtmlElement) -> None:
+    """
+    Set the href of anchor tags from their 'jumptosection' onclick event, in place
+    """
     # Iterate over anchor tags with attribtues
-    for a_tag in parsed_html.find_all("a", attrs={"onclick": True}):
-        if a_tag["onclick"]:
-            match = match_pattern(a_tag["onclick"], pattern_1)
+    for a_tag in html_root.iter("a"):
+        if a_tag.get("onclick"):
+            match = match_pattern(a_tag.get("onclick"), _JUMP_RE)
             if match:
-                a_tag["href"] = f"#{match}"
-    return str(parsed_html)
+                a_tag.set("href", f"#{match}")
 
 
-def match_pattern(text: str, pattern: str):
+def match_pattern(text: str, pattern):
     """
-    Uses a Regular Expression to extract ID from onclick attribute value
+    Uses a compiled Regular Expression to extract ID from onclick attribute value
+    The ID is the first group of the pattern
     """
-    result = re.search(pattern, text)
+    result = pattern.search(text)
     if result:
-        return result.group()
+        return result.group(1)
     else:
         return None
 
 
-def skip_crlf(content):
+def iter_child_nodes(tag: HtmlElement):
     """
-    Skip Adding empty '\\n' or '\\r' in the content
-    New lines will be added from <br> tag or existing CRLF tokens at the end of text.
+    Yield the child nodes of an element in document order.
+    lxml keeps text on `.text` and `.tail`, so these are yielded as plain
+    strings between the child elements. Comments are skipped, but their tail
+    text is kept. A bare '\\n' or '\\r' between tags is skipped as well, new
+    lines come from <br> tags or CRLF tokens at the end of text.
     """
-    if not (isinstance(content, str)):
-        return False
-    if content != "\n" and content != "\r":
-        return False
-    else:
-        return True
-
-
-def add_docx_tables(doc: Document, table_html: Tag):
+    text = tag.text
+    if text and text not in _BARE_NEWLINES:
+        yield text
+    for child in tag:
+        if isinstance(child.tag, str):
+            yield child
+        tail = child.tail
+        if tail and tail not in _BARE_NEWLINES:
+            yield tail
+
+
+def add_docx_tables(ctx: ConversionContext, table_html: HtmlElement):
     """
     Add a docx table object to the Document object from html table tag.
     It extracts all text content and style information from 'style' attributes
     """
 
-    def process_table_cell(cell: Tag, docx_cell: _Cell):
-        style_attrs = None if "style" not in cell.attrs else cell["style"]
+    def process_table_cell(cell: HtmlElement, docx_cell: _Cell):
+        style_attrs = cell.get("style")
         style_data = parse_styles(style_attrs)
         process_p_child_tags(
-            doc, docx_cell.add_paragraph(), cell, cell, docx_cell, style_data
+            ctx, docx_cell.add_paragraph(), cell, cell, docx_cell, style_data
         )
 
-    if not table_html:
+    if table_html is None:
         return
 
-    rows = table_html.find_all("tr")
-    columns = max(len(row.find_all(["td", "th"])) for row in rows)
-    docx_table = doc.add_table(rows=len(rows), cols=columns, style="Table Grid")
-
-    for i, row in enumerate(rows):
-        cells = row.find_all(["td", "th"])
-        for j, cell in enumerate(cells):
-            table_cell = docx_table.cell(i, j)
+    # Collect the cells of each row once, for the column count and the content
+    # Only direct rows and cells, the ones of nested tables belong to their
+    # own table, which is added while processing the outer cell
+    row_cells = [
+        list(row.iterchildren("td", "th"))
+        for row in table_html.xpath("tr | thead/tr | tbody/tr | tfoot/tr")
+    ]
+    columns = max(map(len, row_cells))
+    docx_table = ctx.doc.add_table(
+        rows=len(row_cells), cols=columns, style="Table Grid"
+    )
+    # Move the table in front of the end paragraph, like add_paragraph does
+    if ctx.end is not None:
+        ctx.end._p.addprevious(docx_table._tbl)
+
+    # Table.cell builds the list of all cells on every call, get the cells of
+    # each row once instead
+    for cells, docx_row in zip(row_cells, docx_table.rows):
+        for cell, table_cell in zip(cells, docx_row.cells):
             process_table_cell(cell, table_cell)
 
     return docx_table
 
 
+def run_text_xml(text: str) -> str:
+    """
+    Build the xml content of a run for `text`, like setting `Run.text` does.
+    Tabs become <w:tab/> and line feeds or carriage returns become <w:br/>
+    """
+    xml = []
+    start = 0
+    for i, char in enumerate(text):
+        if char in _RUN_BREAKS:
+            if i > start:
+                xml.append(_t_xml(text[start:i]))
+            xml.append(_RUN_BREAKS[char])
+            start = i + 1
+    if start < len(text):
+        xml.append(_t_xml(text[start:]))
+    return "".join(xml)
+
+
+def _t_xml(text: str) -> str:
+    """<w:t> element for `text`, preserving leading and trailing spaces"""
+    space = ' xml:space="preserve"' if text != text.strip() else ""
+    return f"<w:t{space}>{escape(text)}</w:t>"
+
+
 def create_bookmark_run(paragraph: Paragraph, bookmark_name: str, text: str, id: str):
     """
     Insert text in `paragraph` and surround it with bookmarkStart and bookmarkEnd,
     effectively creating a bookmark within the paragraph.
     """
-    # Create a new run for the text
-    run = paragraph.add_run(text)
-
-    # Get the run's XML element
-    r = run._r
-
     # Generate a unique ID for the bookmark. In Word, bookmark IDs must be numeric.
     # You can maintain a global counter or dictionary to ensure uniqueness if needed.
     # bookmark_id = str(abs(hash(bookmark_name)) % (10**6))
 
-    # --- bookmarkStart ---
-    tag_bookmark_start = OxmlElement("w:bookmarkStart")
-    tag_bookmark_start.set(qn("w:id"), id)
-    tag_bookmark_start.set(qn("w:name"), bookmark_name)
-
-    # --- bookmarkEnd ---
-    tag_bookmark_end = OxmlElement("w:bookmarkEnd")
-    tag_bookmark_end.set(qn("w:id"), id)
-
-    # Insert them around the text run in the XML
-    r.insert_element_before(tag_bookmark_start)
-    r.append(tag_bookmark_end)
+    # Build the run with the text, bookmarkStart and bookmarkEnd in one go
+    paragraph._p.append(
+        parse_xml(
+            _BOOKMARK_RUN_XML.format(
+                text=run_text_xml(text),
+                id=quoteattr(id),
+                name=quoteattr(bookmark_name),
+            )
+        )
+    )
 
 
 def create_internal_hyperlink_run(
@@ -146,33 +374,12 @@ def create_internal_hyperlink_run(
     """
     Insert a run in `paragraph` that links (anchors) to the given bookmark_name within the same document.
     """
-    # Create the <w:hyperlink> element and specify the anchor (bookmark target)
-    hyperlink = OxmlElement("w:hyperlink")
-    hyperlink.set(qn("w:anchor"), bookmark_name)
-    hyperlink.set(
-        qn("w:history"), "1"
-    )  # This just indicates Word should store the link history
-
-    # Create a <w:r> node to hold the text
-    new_run = Run(OxmlElement("w:r"), paragraph)
-    # Create a <w:rPr> for run properties (e.g., formatting)
-    r_pr = OxmlElement("w:rPr")
-
-    r_style = OxmlElement("w:rStyle")
-    r_style.set(qn("w:val"), "Hyperlink")
-    r_pr.append(r_style)
-
-    # Create <w:t> element (text) inside the run
-    w_t = OxmlElement("w:t")
-    w_t.text = display_text
-
-    new_run._element.append(r_pr)
-    new_run._element.append(w_t)
-    new_run.font.color.theme_color = MSO_THEME_COLOR_INDEX.HYPERLINK
-    new_run.font.underline = True
-
-    # Add this <w:r> run into the <w:hyperlink>
-    hyperlink.append(new_run._element)
+    # Build the <w:hyperlink> with the anchor (bookmark target) and the styled run
+    hyperlink = parse_xml(
+        _INTERNAL_HYPERLINK_XML.format(
+            anchor=quoteattr(bookmark_name), text=escape(display_text)
+        )
+    )
 
     # Append the hyperlink into the paragraph
     paragraph._p.append(hyperlink)
@@ -186,135 +393,252 @@ def add_links(paragraph: Paragraph, text: str, url: str):
     part = paragraph.part
     r_id = part.relate_to(url, RELATIONSHIP_TYPE.HYPERLINK, is_external=True)
 
-    # Create the w:hyperlink tag and add needed values
-    hyperlink = OxmlElement("w:hyperlink")
-    hyperlink.set(
-        qn("r:id"),
-        r_id,
+    # Build the w:hyperlink tag with the relation id and the styled run
+    hyperlink = parse_xml(
+        _HYPERLINK_XML.format(r_id=quoteattr(r_id), text=run_text_xml(text))
     )
+    paragraph._p.append(hyperlink)
 
-    # Create a new run object (a wrapper over a 'w:r' element)
-    new_run = Run(OxmlElement("w:r"), paragraph)
-    new_run.text = text
 
-    # new_run.font.underline = True
-    new_run.font.color.theme_color = MSO_THEME_COLOR_INDEX.HYPERLINK
-    new_run.font.underline = True
+def _iter_list_nodes(list_tag: HtmlElement):
+    """
+    Yield (li, node) for the child nodes of each <li> of a list, in document order
+    """
+    for li in list_tag.iterchildren("li"):
+        for node in iter_child_nodes(li):
+            yield li, node
 
-    # Join all the xml elements together
-    hyperlink.append(new_run._element)
-    paragraph._p.append(hyperlink)
+
+def _add_list_paragraph(
+    ctx: ConversionContext,
+    docx_cell: _Cell,
+    list_tag: HtmlElement,
+    level: int,
+    prev: Paragraph,
+) -> Paragraph:
+    """
+    Add the paragraph of a list item, <ol> items continue the numbering of `prev`
+    """
+    style = "List Number" if list_tag.tag == "ol" else "List Bullet"
+    if docx_cell:
+        paragraph = docx_cell.add_paragraph(style=style)
+    else:
+        paragraph = add_paragraph(ctx, style=style)
+    paragraph.paragraph_format.left_indent = Inches(level * 0.25)
+    if list_tag.tag == "ol":
+        number_paragraph(ctx, paragraph, prev)
+    return paragraph
 
 
 def process_list(
-    docx_cell: _Cell, doc: Document, list_tag: Tag, parent_paragraph=None, level=1
+    docx_cell: _Cell,
+    ctx: ConversionContext,
+    list_tag: HtmlElement,
+    parent_paragraph=None,
+    level=1,
 ) -> Paragraph:
     """
     Convert HTML <ul> and <ol> tags containing <li> recursively into docx bullets
+    The text and inline tags of an <li> share one list paragraph, <p> and
+    <blockquote> children get a paragraph of their own
+    Nested lists are walked with an explicit stack of open lists, each one
+    keeps its level, its numbering paragraph and its current <li>
     """
-    for li in list_tag.find_all("li", recursive=False):
-        for child in li.children:
-            if child.name != "ol" and child.name != "ul" and (not skip_crlf(child)):
-                doc_obj = docx_cell if docx_cell else doc
-                paragraph = doc_obj.add_paragraph(
-                    style="List Number" if list_tag.name == "ol" else "List Bullet"
+    # Open lists with their remaining <li> child nodes, the innermost one is last
+    work = [(list_tag, level, _iter_list_nodes(list_tag), parent_paragraph, None)]
+    while work:
+        list_tag, level, nodes, parent_paragraph, li = work[-1]
+        # Paragraph of the inline content of `li`, added by its first text
+        paragraph = None
+        # Text and inline tags of `paragraph`, walked together so their runs
+        # are joined in one batch
+        inline = []
+        for child_li, child in nodes:
+            name = None if isinstance(child, str) else child.tag
+            # The inline content of the list paragraph ends at the next <li>
+            # or block tag
+            if child_li is not li or name in _LIST_BLOCK_TAGS:
+                if inline:
+                    process_p_child_tags(
+                        ctx, paragraph, li, list_tag, docx_cell, {}, nodes=inline
+                    )
+                    inline = []
+                paragraph = None
+                li = child_li
+            # Indentation between the tags of an <li> is not a list item
+            if name is None and child.isspace() and not inline:
+                continue
+            if name == "ol" or name == "ul":
+                # Walk the nested list first, then resume with the rest of `nodes`
+                work[-1] = (list_tag, level, nodes, parent_paragraph, li)
+                work.append((child, level + 1, _iter_list_nodes(child), None, None))
+                break
+            elif name in _HEADING_LEVELS:
+                # Headings are not list items, they keep their heading style
+                lvl = _HEADING_LEVELS[name]
+                if docx_cell:
+                    heading = docx_cell.add_paragraph(style=f"Heading {lvl}")
+                else:
+                    heading = add_heading(ctx, "", lvl)
+                process_p_child_tags(ctx, heading, child, child, docx_cell, {})
+                continue
+            if paragraph is None:
+                paragraph = _add_list_paragraph(
+                    ctx, docx_cell, list_tag, level, parent_paragraph
                 )
-                paragraph.paragraph_format.left_indent = Inches(level * 0.25)
-            if child.name == "a":  # Handle anchor tags
-                add_links(paragraph, child.text, child.get("href", ""))
-            elif child.name in ["p", "blockquote"]:
-                if paragraph.style.name == "List Number":
-                    list_number(doc, paragraph, prev=parent_paragraph)
-                style_str = None if "style" not in child.attrs else child["style"]
+                parent_paragraph = paragraph
+            if name in ["p", "blockquote"]:
+                style_str = child.get("style")
                 style_dict = parse_styles(style_str)
                 align_para(style_dict, paragraph)
-                if "id" in child.attrs:
-                    create_bookmark_run(paragraph, child["id"], "", child["id"])
+                if "id" in child.attrib:
+                    create_bookmark_run(paragraph, child.get("id"), "", child.get("id"))
                 process_p_child_tags(
-                    doc, paragraph, child, child, docx_cell, style_dict
+                    ctx, paragraph, child, child, docx_cell, style_dict
                 )
-                parent_paragraph = paragraph
-            elif child.name == "ol" or child.name == "ul":
-                process_list(
-                    docx_cell, doc, child, parent_paragraph=None, level=level + 1
-                )
-            elif child.name == "table" and child.parent.name == "li":
-                table = add_docx_tables(doc, child)
+                paragraph = None
+            elif name == "table":
+                table = add_docx_tables(ctx, child)
                 tbl, p = table._tbl, paragraph._p
                 p.addnext(tbl)
+                paragraph = None
+            else:
+                # Text and inline tags like <a>, <b> or <div>
+                inline.append(child)
+        else:
+            if inline:
+                process_p_child_tags(
+                    ctx, paragraph, li, list_tag, docx_cell, {}, nodes=inline
+                )
+            work.pop()
 
+    # The outermost list is popped last
     return parent_paragraph
 
 
-def is_list_continued(list_tag: Tag):
+def number_paragraph(ctx: ConversionContext, paragraph: Paragraph, prev: Paragraph):
+    """
+    Number a list paragraph, continuing the numbering of `prev`
+    list_number only allocates a new numbering when there is no numbered `prev`,
+    otherwise the <w:numPr> of `prev` is copied instead of rebuilt
+    """
+    num_pr = None if prev is None or prev._p.pPr is None else prev._p.pPr.numPr
+    if num_pr is None or num_pr.numId is None:
+        list_number(ctx.doc, paragraph, prev=prev)
+    else:
+        paragraph._p.get_or_add_pPr()._insert_numPr(deepcopy(num_pr))
+
+
+def is_list_continued(list_tag: HtmlElement):
     """
     Check if an <ol> list is flat with only one <li>
     and continuing sequence
     """
-    next_tags = list_tag.find_next_siblings("ol")
-    prev_tags = list_tag.find_previous_siblings("ol")
+    # Only the nearest "ol" sibling on each side is needed, stop scanning there
+    next_sibling = next(list_tag.itersiblings("ol"), None)
+    has_prev = next(list_tag.itersiblings("ol", preceding=True), None) is not None
 
     # Check following "ol" tags
-    if len(next_tags) == 0 and len(prev_tags) == 0:
-        return False
-    elif len(prev_tags) > 0 and len(next_tags) == 0:
-        return True
+    if next_sibling is None:
+        return has_prev
 
-    next_sibling = next_tags[0]
     # check <ol> with "start" and no "value" attribute in <li>
-    if next_sibling.name == "ol":
-        if "start" in next_sibling.attrs and "start" not in list_tag.attrs:
+    if next_sibling.tag == "ol":
+        if "start" in next_sibling.attrib and "start" not in list_tag.attrib:
             return False
-        elif "start" in next_sibling.attrs and "start" in list_tag.attrs:
+        elif "start" in next_sibling.attrib and "start" in list_tag.attrib:
             return True
-        elif "start" not in next_sibling.attrs and "start" in list_tag.attrs:
+        elif "start" not in next_sibling.attrib and "start" in list_tag.attrib:
             return True
-    elif next_sibling.name != "ol" and next_sibling.name != "ul":
+    elif next_sibling.tag != "ol" and next_sibling.tag != "ul":
         return False
     # check li tags
-    for li in list_tag.find_all("li", recursive=False):
-        if "value" in li.attrs:
-            current_li_val = li["value"]
-            sibling_li = next_sibling.find_all("li", recursive=False)
+    for li in list_tag.iterchildren("li"):
+        if "value" in li.attrib:
+            current_li_val = li.get("value")
+            sibling_li = next_sibling.iterchildren("li")
             for sib_li in sibling_li:
-                if "value" in sib_li.attrs:
-                    return int(sib_li["value"]) - int(current_li_val) == 1
+                if "value" in sib_li.attrib:
+                    return int(sib_li.get("value")) - int(current_li_val) == 1
                 else:
                     return False
         else:
             return False
 
 
-def add_images(img: Tag):
+def download_image(session: requests.Session, img_url: str) -> BytesIO:
+    """
+    Stream an image into a buffer in chunks of 64KB
+    Returns None for images bigger than _MAX_IMAGE_BYTES, these are rejected
+    by their Content-Length before downloading when the server sends it
+    """
+    with session.get(img_url, timeout=(3, 10), stream=True) as response:
+        response.raise_for_status()
+        if int(response.headers.get("Content-Length", 0)) > _MAX_IMAGE_BYTES:
+            return None
+        img_buff = BytesIO()
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            img_buff.write(chunk)
+            if img_buff.tell() > _MAX_IMAGE_BYTES:
+                return None
+    img_buff.seek(0)
+    return img_buff
+
+
+def add_images(img: HtmlElement, session: requests.Session = _SESSION):
     """
     Adds Picture to docx Document
     Downloads image from src url or converts base64 encoded data
     """
-    if "src" in img.attrs:
-        img_url = img["src"]
+    if "src" in img.attrib:
+        img_url = img.get("src")
         err_msg_https = f"Image not available, {img_url}"
         err_msg_img_data = "Image not available"
         image = None
         try:
             # Download image
             if img_url.startswith("https"):
-                response = requests.get(img_url)
-                response.raise_for_status()
-                image = Image.open(BytesIO(response.content))
+                img_data = download_image(session, img_url)
+                if img_data is None:
+                    return f"Image too large, {img_url}"
+                image = Image.open(img_data)
             # Convert raw base64 encoded image data
             elif img_url.startswith("data"):
-                img_b64 = img_url.split(",")
-                data = base64.urlsafe_b64decode(img_b64[1])
-                img_format = img_b64[0].split(";")[0].split("/")[1].upper()
-                image = Image.open(BytesIO(data), formats=[img_format, "JPEG"])
+                # data:image/png;base64,<payload>
+                header, _, payload = img_url[5:].partition(",")
+                img_data = BytesIO(base64.urlsafe_b64decode(payload))
+                img_format = header.split(";", 1)[0].split("/", 1)[1].upper()
+                image = Image.open(img_data, formats=[img_format, "JPEG"])
+            # Image.open only reads the header, small images are added as they
+            # are without decoding and encoding them again
+            # The image is not closed here, that would close the returned buffer
+            if image.width <= _IMAGE_SIZE[0] and image.height <= _IMAGE_SIZE[1]:
+                img_data.seek(0)
+                return img_data
             img_buff = BytesIO()
-            image.thumbnail((500, 400), Image.Resampling.LANCZOS)
-            image.save(img_buff, format=image.format, quality=90)
+            image.thumbnail(_IMAGE_SIZE, Image.Resampling.LANCZOS)
+            # quality only applies to JPEG, other formats use their defaults
+            if image.format == "JPEG":
+                image.save(img_buff, format=image.format, quality=85)
+            else:
+                image.save(img_buff, format=image.format)
+            # Release the decoded pixels right away, closing the image closes
+            # the source buffer as well, only the resized image is kept
+            image.close()
             img_buff.seek(0)
             return img_buff
         except Exception as e:
             err = err_msg_https if img_url.startswith("https") else err_msg_img_data
-            traceback.print_exc()
+            # One line per failed image, the traceback only when debugging
+            # The url is cut short, data URIs hold the whole image
+            _LOGGER.warning(
+                "Failed to load image %.100s: %s",
+                img_url,
+                e,
+                exc_info=_LOGGER.isEnabledFor(logging.DEBUG),
+            )
+            if image is not None:
+                image.close()
             return err
     # if html <img> tag does not have src attribute
     else:
@@ -324,11 +648,68 @@ def add_images(img: Tag):
 def rgb_to_hex(rgb: str):
     """
     Parses an rgb string like rbg(233,42,12) to return #E92A0C
+    Other values are returned unchanged
     """
-    match = re.match(r"rgb\((\d{1,3}),\s*(\d{1,3}),\s*(\d{1,3})\)", rgb)
-    if match:
-        return "{:02X}{:02X}{:02X}".format(*map(int, match.groups()))
-    return rgb
+    # Most style values are not rgb colors, skip them without parsing
+    if not rgb.startswith("rgb("):
+        return rgb
+    channels = rgb[4:].partition(")")[0].split(",")
+    try:
+        r, g, b = (int(channel) for channel in channels)
+    except ValueError:
+        return rgb
+    return "{:02X}{:02X}{:02X}".format(r, g, b)
+
+
+def parse_color(value: str) -> tuple[int, int, int]:
+    """
+    Parses a css color value like #E92A0C or rgb(233, 42, 12) to return (233, 42, 12)
+    Returns None for other values, like named colors
+    """
+    match = _COLOR_RE.match(value)
+    if match is None:
+        return None
+    if match.group(1):
+        return hex_to_rgb(match.group(1))
+    return tuple(min(int(channel), 255) for channel in match.group(2, 3, 4))
+
+
+def hex_to_rgb(hex_color: str) -> tuple[int, int, int]:
+    """
+    Parses a hex color string like E92A0C to return (233, 42, 12)
+    Returns None for values which are not hex colors
+    """
+    if len(hex_color) < 6:
+        return None
+    # Parse the six digits at once and split the channels with bit shifts
+    try:
+        value = int(hex_color[:6], 16)
+    except ValueError:
+        return None
+    return (value >> 16) & 0xFF, (value >> 8) & 0xFF, value & 0xFF
+
+
+@lru_cache(maxsize=4096)
+def parse_style_items(style_attr: str) -> tuple[tuple[str, str], ...]:
+    """
+    Parse an html style attribute string into (property, value) pairs
+    The "color" value is parsed to an (r, g, b) tuple and left out if invalid
+    Results are cached as documents repeat the same style strings a lot
+    """
+    style_items = []
+    if not style_attr:
+        return ()
+    for match in _STYLE_RE.finditer(style_attr):
+        # Property names are case insensitive in css
+        k, v = match.group(1).lower(), match.group(2).strip()
+        if k == "color":
+            v = parse_color(v)
+            if v is None:
+                continue
+        else:
+            v = v.lstrip("#") if "#" in v else rgb_to_hex(v)
+        style_items.append((k, v))
+    return tuple(style_items)
 
 
 def parse_styles(style_attr: str) -> dict[str, str]:
@@ -336,197 +717,244 @@ def parse_styles(style_attr: str) -> dict[str, str]:
     Create a python dictionary of styles from html style attribute string
     Ex: style=color: red;background-color: blue
     Returns: {color: red, background-color: blue}
+    A new dictionary is returned on every call, so callers can update it
     """
-    style_dict = {}
-    if not style_attr:
-        return style_dict
-    for style_itm in style_attr.split(";"):
-        if ":" in style_itm:
-            k, v = style_itm.split(":")
-            style_dict[k.strip()] = (
-                v.strip().lstrip("#") if "#" in v else rgb_to_hex(v.strip())
-            )
-    return style_dict
+    return dict(parse_style_items(style_attr))
 
 
-def add_text_color(paragraph, text, styles=None, is_bg_color=False) -> None:
+def run_style_xml(styles: dict) -> str:
     """
-    Add Styles to paragraph based on given style attributes from html
+    Build the <w:rPr> of a run based on given style attributes from html
+    Properties are written in the order of the schema, like python-docx does
     """
-    run = paragraph.add_run(text)
-    if styles:
-        try:
-            if "color" in styles.get("span", ""):
-                text_color = styles.get("span").get("color", "000000")
-                rgb = tuple(int(text_color[i : i + 2], 16) for i in (0, 2, 4))
-                run.font.color.rgb = RGBColor(*rgb)
-            if "bold" in styles:
-                run.bold = styles["bold"]
-            if "italic" in styles:
-                run.italic = styles["italic"]
-            if "underline" in styles:
-                run.underline = styles["underline"]
-            if "font-family" in styles and "bold" in styles.get("font-family"):
-                run.bold = True
-        except ValueError:
-            pass  # Skip if the color value is invalid
-
-
-def tuple_check(tag, style, ancestors, style_d):
-    tag_1, tag_2 = tag
-    if (tag_1 not in ancestors) and (tag_2 not in ancestors):
-        style_d[style] = False
+    props = []
+    bold = styles.get("bold")
+    if "font-family" in styles and "bold" in styles.get("font-family"):
+        bold = True
+    if bold:
+        props.append("<w:b/>")
+    if styles.get("italic"):
+        props.append("<w:i/>")
+    # Colors are already parsed to (r, g, b) by parse_styles
+    text_color = styles.get("span", {}).get("color")
+    if text_color:
+        props.append('<w:color w:val="%02X%02X%02X"/>' % text_color)
+    if styles.get("underline"):
+        props.append('<w:u w:val="single"/>')
+    if not props:
+        return ""
+    return f"<w:rPr>{''.join(props)}</w:rPr>"
+
+
+def _flush_runs(paragraph: Paragraph, run_specs: list[tuple[str, dict]]) -> None:
+    """
+    Append the styled text runs of `run_specs` to `paragraph`
+    The runs are built as one xml fragment and parsed once, instead of
+    adding and styling every run through python-docx
+    """
+    if not run_specs:
+        return
+    runs = []
+    # Text nodes of the same tag share one styles dict, build its rPr once
+    last_styles = rpr = None
+    for text, styles in run_specs:
+        if styles is not last_styles:
+            last_styles, rpr = styles, run_style_xml(styles)
+        runs.append(f"<w:r>{rpr}{run_text_xml(text)}</w:r>")
+    runs = "".join(runs)
+    paragraph._p.extend(parse_xml(_RUNS_XML.format(runs=runs)))
+
+
+def _handle_br(ctx, paragraph, child, tag, parent_tag, cell, styles):
+    """add new line or line-break"""
+    run = paragraph.add_run()
+    run.add_break()
+
+
+def _handle_p(ctx, paragraph, child, tag, parent_tag, cell, styles):
+    """add <p> styles and child tags"""
+    if "id" in child.attrib:
+        create_bookmark_run(paragraph, child.get("id"), "", child.get("id"))
+    if cell is not None:
+        return cell.add_paragraph(), child, tag, styles
+    return paragraph, child, tag, styles
+
+
+def _handle_heading(ctx, paragraph, child, tag, parent_tag, cell, styles):
+    """add headings"""
+    lvl = _HEADING_LEVELS[child.tag]
+    if cell is None:
+        heading = add_heading(ctx, "", lvl)
     else:
-        style_d[style] = True
+        heading = cell.add_paragraph("", style=f"Heading {lvl}")
+    return heading, child, parent_tag, {}
 
 
-def check_style_parent(ancestors: [], style_d: dict, tag_names: dict) -> dict[str, str]:
-    """
-    Remove the styles which are not in any direct parent or ancestor of the current tag
-    """
-    for tag, style in tag_names.items():
-        if isinstance(tag, tuple):
-            tuple_check(tag, style, ancestors, style_d)
-        else:
-            if tag not in ancestors:
-                style_d[style] = {} if tag == "span" else False
-    return style_d
+def _handle_div(ctx, paragraph, child, tag, parent_tag, cell, styles):
+    """walk <div> and <section> containers for their text and block tags"""
+    # Like <p>, a container starts a new paragraph in table cells
+    return _handle_p(ctx, paragraph, child, tag, parent_tag, cell, styles)
+
+
+def _handle_span(ctx, paragraph, child, tag, parent_tag, cell, styles):
+    """add <span> styles and child tags"""
+    if "bookmark" in child.classes:
+        create_bookmark_run(
+            paragraph, child.get("name"), child.text_content(), child.get("id")
+        )
+    elif "anchor" in child.classes:
+        create_bookmark_run(paragraph, child.get("id"), "", child.get("id"))
+    else:
+        span_styles = {**styles, "span": parse_styles(child.get("style", ""))}
+        return paragraph, child, tag, span_styles
+
+
+def _handle_style_tag(ctx, paragraph, child, tag, parent_tag, cell, styles):
+    """add bold <strong> <b>, italic <em> <i> and underline <u> styles"""
+    tag_styles = {**styles, _STYLE_TAG_MAP[child.tag]: True}
+    return paragraph, child, tag, tag_styles
+
+
+def _handle_mark(ctx, paragraph, child, tag, parent_tag, cell, styles):
+    """add mark styles <mark> and child tags"""
+    return paragraph, child, tag, styles
+
+
+# def _handle_img(ctx, paragraph, child, tag, parent_tag, cell, styles):
+#     """add image under <p> tag"""
+#     img_data = add_images(child, ctx.session)
+#     if isinstance(img_data, str):
+#         skip_image(ctx, cell, img_data)
+#     else:
+#         run = paragraph.add_run()
+#         run.add_picture(img_data)
+#         img_data.close()
+
+
+def _handle_a(ctx, paragraph, child, tag, parent_tag, cell, styles):
+    """add anchor tags inside <p>"""
+    if "anchor-link" in child.classes:
+        a_id = child.get("class").split()[0]
+        bookmark_span = ctx.id_map.get(a_id)
+        if bookmark_span is not None:
+            bk_name = bookmark_span.get("name", bookmark_span.get("id"))
+            create_internal_hyperlink_run(paragraph, child.text_content(), bk_name)
+    else:
+        add_links(paragraph, child.text_content(), child.get("href", ""))
+
+
+def _handle_list(ctx, paragraph, child, tag, parent_tag, cell, styles):
+    """add lists inside paragraph"""
+    # `tag` is the parent of `child`, no need to look it up
+    if tag.tag == "td":
+        process_list(cell, ctx, child)
+    else:
+        process_list(None, ctx, child)
+
+
+def _handle_table(ctx, paragraph, child, tag, parent_tag, cell, styles):
+    """add table inside paragraph"""
+    add_docx_tables(ctx, child)
+
+
+def _handle_blockquote(ctx, paragraph, child, tag, parent_tag, cell, styles):
+    """process blockquote tags"""
+    if tag.tag in ("td", "th"):
+        process_blockquote_paragraphs(ctx, child, cell)
+
+
+# Tags which only set the styles of their text, the text runs of the parent
+# tag are still buffered while walking them
+_BUFFERED_TAGS = frozenset((*_STYLE_TAG_MAP, "mark", "span"))
+
+# Handlers for the child tags of process_p_child_tags, by tag name
+# Handlers of tags with nested text return (paragraph, tag, parent_tag, styles)
+# to walk next, instead of calling process_p_child_tags themselves
+_CHILD_HANDLERS = {
+    "br": _handle_br,
+    "p": _handle_p,
+    **{heading: _handle_heading for heading in _HEADING_LEVELS},
+    "div": _handle_div,
+    "section": _handle_div,
+    "span": _handle_span,
+    **{style_tag: _handle_style_tag for style_tag in _STYLE_TAG_MAP},
+    "mark": _handle_mark,
+    # "img": _handle_img,
+    "a": _handle_a,
+    "ul": _handle_list,
+    "ol": _handle_list,
+    "table": _handle_table,
+    "blockquote": _handle_blockquote,
+}
 
 
 def process_p_child_tags(
-    doc: Document,
+    ctx: ConversionContext,
     paragraph: Paragraph,
-    tag: Tag,
-    parent_tag: Tag,
+    tag: HtmlElement,
+    parent_tag: HtmlElement,
     cell: _Cell,
     styles=None,
+    nodes=None,
 ) -> None:
-    """Processes child tags of a p tag or other tags like <td>, <li>..."""
-    for child in tag.children:
-        ancestors = [tag.name] + [t.name for t in tag.parents]
-        if (
-            isinstance(child, str)
-            and (child.parent.name == tag.name)
-            and (not skip_crlf(child))
-        ):
-            if not styles:
-                run = paragraph.add_run()
-                run.text = child
-            else:
-                styles = check_style_parent(
-                    ancestors,
-                    styles,
-                    {
-                        "span": "span",
-                        ("b", "strong"): "bold",
-                        ("i", "em"): "italic",
-                        "u": "underline",
-                    },
-                )
-                add_text_color(paragraph, child, styles)
-
-        # add new line or line-break
-        elif child.name == "br":
-            run = paragraph.add_run()
-            run.add_break()
-
-        # add <p> styles and child tags
-        elif child.name == "p":
-            if "id" in child.attrs:
-                create_bookmark_run(paragraph, child["id"], "", child["id"])
-            if cell is not None:
-                process_p_child_tags(
-                    doc, cell.add_paragraph(), child, tag, cell, styles
-                )
-            else:
-                process_p_child_tags(doc, paragraph, child, tag, cell, styles)
-
-        # add headings
-        elif child.name in ["h1", "h2", "h3", "h4", "h5", "h6"]:
-            lvl = int(child.name[1])
-            heading = cell.add_paragraph("", style=f"Heading {lvl}")
-            process_p_child_tags(doc, heading, child, parent_tag, cell)
-
-        # add <span> styles and child tags
-        elif child.name == "span":
-            span_styles = parse_styles(child.get("style", ""))
-            styles.update({"span": span_styles})
-            if "class" in child.attrs and "bookmark" in child["class"]:
-                create_bookmark_run(paragraph, child["name"], child.text, child["id"])
-            elif "class" in child.attrs and "anchor" in child["class"]:
-                create_bookmark_run(paragraph, child["id"], "", child["id"])
-            else:
-                process_p_child_tags(doc, paragraph, child, tag, cell, styles)
-
-        # add <strong> or <b> styles for bold and child tags
-        elif child.name == "strong" or child.name == "b":
-            bold_styles = {"bold": True}
-            styles.update(bold_styles)
-            styles = check_style_parent(ancestors, styles, {"span": "span"})
-            process_p_child_tags(doc, paragraph, child, tag, cell, styles)
-
-        # add italic styles <em> or <i>
-        elif child.name == "em" or child.name == "i":
-            italic_styles = {"italic": True}
-            styles.update(italic_styles)
-            tags = {
-                "span": "span",
-                ("b", "strong"): "bold",
-            }
-            styles = check_style_parent(ancestors, styles, tags)
-            process_p_child_tags(doc, paragraph, child, tag, cell, styles)
-
-        # add underline styles <u> and child tags
-        elif child.name == "u":
-            underline_styles = {"underline": True}
-            styles.update(underline_styles)
-            tags = {"span": "span", ("b", "strong"): "bold", ("i", "em"): "italic"}
-            styles = check_style_parent(ancestors, styles, tags)
-            process_p_child_tags(doc, paragraph, child, tag, cell, styles)
-
-        # add mark styles <mark> and child tags
-        elif child.name == "mark":
-            process_p_child_tags(doc, paragraph, child, tag, cell, styles)
-
-        # add image under <p> tag
-        # elif child.name == "img":
-        #     img_data = add_images(child)
-        #     if isinstance(img_data, str):
-        #         skip_image(doc, cell, img_data)
-        #     else:
-        #         run = paragraph.add_run()
-        #         run.add_picture(img_data)
-        #         img_data.close()
-
-        # add anchor tags inside <p>
-        elif child.name == "a":
-            if "class" in child.attrs and "anchor-link" in child["class"]:
-                a_id = child["class"][0]
-                bookmark_span = soup.find(id=a_id)
-                if bookmark_span:
-                    bk_name = (
-                        bookmark_span["name"]
-                        if "name" in bookmark_span.attrs
-                        else bookmark_span["id"]
+    """
+    Processes child tags of a p tag or other tags like <td>, <li>...
+    `styles` are the active styles of `tag`. Style tags push a copy with
+    their own style for their children, so the text nodes read them directly
+    Child tags are dispatched to their handler in _CHILD_HANDLERS
+    Nested tags are walked with an explicit stack of open tags, so deeply
+    nested markup does not recurse
+    Text runs are buffered and added to their paragraph in one batch, before
+    any handler that adds other content
+    `nodes` are walked instead of all the child nodes of `tag`, if given
+    """
+    if styles is None:
+        styles = {}
+    if nodes is None:
+        nodes = iter_child_nodes(tag)
+    # Buffered (text, styles) runs of `runs_paragraph`
+    runs = []
+    runs_paragraph = paragraph
+    # Open tags with their remaining child nodes, the innermost one is last
+    work = [(paragraph, iter(nodes), tag, parent_tag, styles)]
+    while work:
+        paragraph, nodes, tag, parent_tag, styles = work[-1]
+        for child in nodes:
+            if isinstance(child, str):
+                # Pretty printed html indents the block tags of a container,
+                # a single space between inline tags is still kept
+                if tag.tag in _BLOCK_CONTAINERS and child.isspace() and "\n" in child:
+                    continue
+                if paragraph is not runs_paragraph:
+                    _flush_runs(runs_paragraph, runs)
+                    runs.clear()
+                    runs_paragraph = paragraph
+                runs.append((child, styles))
+                continue
+            handler = _CHILD_HANDLERS.get(child.tag)
+            if handler is None:
+                continue
+            # Bookmarks, links and breaks must come after the buffered text
+            if child.tag not in _BUFFERED_TAGS or child.get("class"):
+                _flush_runs(runs_paragraph, runs)
+                runs.clear()
+            nested = handler(ctx, paragraph, child, tag, parent_tag, cell, styles)
+            if nested is not None:
+                # Walk the nested tag first, then resume with the rest of `nodes`
+                nested_p, nested_tag, nested_parent, nested_styles = nested
+                work.append(
+                    (
+                        nested_p,
+                        iter_child_nodes(nested_tag),
+                        nested_tag,
+                        nested_parent,
+                        nested_styles,
                     )
-                    create_internal_hyperlink_run(paragraph, child.text, bk_name)
-            else:
-                add_links(paragraph, child.text, child.get("href", ""))
-
-        # add lists inside paragraph
-        elif child.name == "ul" or child.name == "ol":
-            if child.parent.name == "td":
-                process_list(cell, doc, child)
-            else:
-                process_list(None, doc, child)
-
-        # add table inside paragraph
-        elif child.name == "table":
-            add_docx_tables(doc, child)
-
-        # process blockquote tags
-        elif child.name == "blockquote" and child.parent.name in ["td", "th"]:
-            process_blockquote_paragraphs(doc, child, cell)
+                )
+                break
+        else:
+            work.pop()
+    _flush_runs(runs_paragraph, runs)
 
 
 def align_para(style_dict: dict[str, str], paragraph: Paragraph):
@@ -569,7 +997,7 @@ def set_document_margin(doc: Document) -> None:
         section.bottom_margin = Inches(1)
 
 
-def skip_image(doc: Document, cell: _Cell, err_msg: str) -> None:
+def skip_image(ctx: ConversionContext, cell: _Cell, err_msg: str) -> None:
     """
     Skip an invalid image and adds a paragraph text with error message
     """
@@ -580,124 +1008,179 @@ def skip_image(doc: Document, cell: _Cell, err_msg: str) -> None:
         run.bold = True
         run.italic = True
     else:
-        p = doc.add_paragraph()
+        p = add_paragraph(ctx)
         run = p.add_run()
         run.text = err_msg
         run.bold = True
         run.italic = True
 
 
-def process_blockquote_paragraphs(doc: Document, tag: Tag, cell: _Cell):
+def process_blockquote_paragraphs(
+    ctx: ConversionContext, tag: HtmlElement, cell: _Cell
+):
     """
     Add <p> tags to document, which are inside <blockquote> tag in html
     """
-    for p_tags in tag.children:
-        if isinstance(p_tags, str) and (not skip_crlf(p_tags)):
-            paragraph = doc.add_paragraph() if cell is None else cell.add_paragraph()
+    for p_tags in iter_child_nodes(tag):
+        if isinstance(p_tags, str):
+            # Indentation between the tags is not a paragraph
+            if p_tags.isspace():
+                continue
+            paragraph = add_paragraph(ctx) if cell is None else cell.add_paragraph()
             run = paragraph.add_run()
             run.text = p_tags
         elif not isinstance(p_tags, str):
-            paragraph = doc.add_paragraph() if cell is None else cell.add_paragraph()
-            process_p_child_tags(doc, paragraph, p_tags, tag, None, {})
+            # Lists and tables are block content of their own
+            if p_tags.tag == "ul" or p_tags.tag == "ol":
+                process_list(cell, ctx, p_tags)
+                continue
+            elif p_tags.tag == "table":
+                add_docx_tables(ctx, p_tags)
+                continue
+            paragraph = add_paragraph(ctx) if cell is None else cell.add_paragraph()
+            process_p_child_tags(ctx, paragraph, p_tags, tag, None, {})
+
+
+def _block_heading(ctx, tag, list_prev_p):
+    """Add Heading in docx"""
+    lvl = _HEADING_LEVELS[tag.tag]
+    heading = add_heading(ctx, "", lvl)
+    process_p_child_tags(ctx, heading, tag, tag, None, {})
+    if "id" in tag.attrib:
+        create_bookmark_run(heading, tag.get("id"), "", tag.get("id"))
+    return list_prev_p
+
+
+# def _block_img(ctx, tag, list_prev_p):
+#     """Add Pictures"""
+#     img_data = add_images(tag, ctx.session)
+#     if isinstance(img_data, str):
+#         skip_image(ctx, None, img_data)
+#     else:
+#         add_paragraph(ctx).add_run().add_picture(img_data)
+#         img_data.close()
+#     return list_prev_p
+
+
+def _block_p(ctx, tag, list_prev_p):
+    """Add Paragraphs and nested tags"""
+    paragraph = add_paragraph(ctx)
+    style_str = tag.get("style")
+    style_dict = parse_styles(style_str)
+    align_para(style_dict, paragraph)
+    if "id" in tag.attrib:
+        create_bookmark_run(paragraph, tag.get("id"), "", tag.get("id"))
+    process_p_child_tags(ctx, paragraph, tag, tag, None, style_dict)
+    return list_prev_p
+
+
+def _block_blockquote(ctx, tag, list_prev_p):
+    """Add paragraphs in <blockquote> tag"""
+    process_blockquote_paragraphs(ctx, tag, None)
+    return list_prev_p
+
+
+def _block_div(ctx, tag, list_prev_p):
+    """Add div tag content, other <div> tags are walked for their block tags"""
+    if "note" not in tag.classes:
+        return process_block_tags(ctx, tag, list_prev_p)
+    paragraph = add_paragraph(ctx)
+    process_p_child_tags(ctx, paragraph, tag, tag, None, {})
+    return list_prev_p
+
+
+def _block_list(ctx, tag, list_prev_p):
+    """Add Lists oustide <p> tags"""
+    if is_list_continued(tag):
+        return process_list(None, ctx, tag, parent_paragraph=list_prev_p)
+    return process_list(None, ctx, tag)
+
+
+def _block_table(ctx, tag, list_prev_p):
+    """Add HTML Tables to Docx"""
+    add_docx_tables(ctx, tag)
+    return list_prev_p
+
+
+def _block_a(ctx, tag, list_prev_p):
+    """Add Hyperlinks [or anchor links based on structure]"""
+    add_links(add_paragraph(ctx), tag.text_content(), tag.attrib["href"])
+    return list_prev_p
+
+
+# Handlers for the block tags of process_block_tags, by tag name
+# Each handler returns the last paragraph of a numbered list, for continuation
+_BLOCK_HANDLERS = {
+    **{heading: _block_heading for heading in _HEADING_LEVELS},
+    # "img": _block_img,
+    "p": _block_p,
+    "blockquote": _block_blockquote,
+    "div": _block_div,
+    "ul": _block_list,
+    "ol": _block_list,
+    "table": _block_table,
+    "a": _block_a,
+}
+
+
+def process_block_tags(
+    ctx: ConversionContext, container: HtmlElement, list_prev_p: Paragraph = None
+) -> Paragraph:
+    """
+    Add the block level children of `container` to the document.
+    Only direct children are visited, nested content is handled by the
+    tag processors. Other container tags like <div> or <section> are
+    walked recursively.
+    Block tags are dispatched to their handler in _BLOCK_HANDLERS
+    Returns the last paragraph of a numbered list for list continuation
+    """
+    for tag in container.iterchildren():
+        handler = _BLOCK_HANDLERS.get(tag.tag)
+        if handler is not None:
+            list_prev_p = handler(ctx, tag, list_prev_p)
+        # Walk other containers like <section> for their block tags
+        elif isinstance(tag.tag, str):
+            list_prev_p = process_block_tags(ctx, tag, list_prev_p)
+
+    return list_prev_p
 
 
-def html_to_docx(html: str) -> BytesIO:
+def html_to_docx(html: str | bytes | HtmlElement) -> BytesIO:
     """
     A Utility method to convert html to docx
-    Takes an html string as input and returns docx object as bytes
+    Takes an html string, or an already parsed tree like the one from
+    _prepare_tree, as input and returns docx object as bytes
+    Raw bytes, like the content of a file opened in "rb" mode, are parsed
+    without decoding them to a string first, with their declared charset
+    or as UTF-8 when they have none
     """
     # Create Docx document object
     doc = Document()
 
     # Create parsed html object for tree navigation
-    global soup
-    soup = BeautifulSoup(html, "lxml")
+    if isinstance(html, (str, bytes)):
+        root = parse_html(html)
+    else:
+        root = html
+    ctx = ConversionContext(doc=doc, id_map=build_id_map(root))
 
     # Assign title informatio in document properties
-    doc.core_properties.title = (
-        soup.title.string if soup.title else "Converted Document"
-    )
+    # <title> is a direct child of <head>, no need to search the whole document
+    head = root.find("head")
+    title = head.find("title") if head is not None else None
+    # Resolve the text once, empty titles fall back like missing ones
+    title_text = (title.text or "").strip() if title is not None else ""
+    title_text = title_text or "Converted Document"
+    doc.core_properties.title = title_text
 
     # Add Document Title to Docx object
-    doc.add_heading(doc.core_properties.title, level=0)
-
-    list_prev_p = None
-    # Iterate over child tags in document body
-    for tag in soup.body.descendants:
-        # Add Heading in docx
-        if tag.name in ["h1", "h2", "h3", "h4", "h5", "h6"] and tag.parent.name not in [
-            "td",
-            "th",
-        ]:
-            lvl = int(tag.name[1])
-            heading = doc.add_heading("", level=lvl)
-            process_p_child_tags(doc, heading, tag, tag, None, {})
-            if "id" in tag.attrs:
-                create_bookmark_run(heading, tag["id"], "", tag["id"])
-        # Add Pictures
-        # elif tag.name == "img" and tag.parent.name not in ["p", "li", "td", "th"]:
-        #     img_data = add_images(tag)
-        #     if isinstance(img_data, str):
-        #         skip_image(doc, None, img_data)
-        #     else:
-        #         doc.add_picture(img_data)
-        #         img_data.close()
-        # Skip empty newlines
-        elif skip_crlf(tag):
-            continue
-
-        # Add Paragraphs and nested tags
-        elif tag.name == "p" and tag.parent.name not in [
-            "li",
-            "td",
-            "th",
-            "blockquote",
-        ]:
-            paragraph = doc.add_paragraph()
-            style_str = None if "style" not in tag.attrs else tag["style"]
-            style_dict = parse_styles(style_str)
-            align_para(style_dict, paragraph)
-            if "id" in tag.attrs:
-                create_bookmark_run(paragraph, tag["id"], "", tag["id"])
-            process_p_child_tags(doc, paragraph, tag, tag, None, style_dict)
-
-        # Add paragraphs in <blockquote> tag
-        elif tag.name == "blockquote" and tag.parent.name in ["div", "body"]:
-            process_blockquote_paragraphs(doc, tag, None)
-
-        # Add div tag content
-        elif tag.name == "div":
-            if "class" in tag.attrs and "note" in tag["class"]:
-                paragraph = doc.add_paragraph()
-                process_p_child_tags(doc, paragraph, tag, tag, None, {})
-
-        # Add Lists oustide <p> tags
-        elif (tag.name == "ul" or tag.name == "ol") and tag.parent.name not in [
-            "td",
-            "th",
-            "li",
-        ]:
-            if is_list_continued(tag):
-                list_prev_p = process_list(None, doc, tag, parent_paragraph=list_prev_p)
-            else:
-                list_prev_p = process_list(None, doc, tag)
-        # Add HTML Tables to Docx
-        elif tag.name == "table" and tag.parent.name not in ["li", "p"]:
-            add_docx_tables(doc, tag)
-        # Add Hyperlinks [or anchor links based on structure]
-        elif tag.name == "a" and tag.parent.name not in [
-            "p",
-            "li",
-            "td",
-            "th",
-            "h1",
-            "h2",
-            "h3",
-            "h4",
-            "h5",
-            "h6",
-        ]:
-            add_links(doc.add_paragraph(), tag.text, tag["href"])
+    doc.add_heading(title_text, level=0)
+
+    # Iterate over the block tags in document body
+    ctx.end = doc.add_paragraph()
+    process_block_tags(ctx, root.body)
+    ctx.end._p.getparent().remove(ctx.end._p)
+    ctx.end = None
 
     set_document_margin(doc)
     # return docx output
@@ -705,3 +1188,34 @@ def html_to_docx(html: str) -> BytesIO:
     doc.save(io)
     io.seek(0)
     return io
+
+
+def convert(html: str | bytes | HtmlElement, out_path: str) -> None:
+    """
+    Convert html to docx and write it to `out_path`
+    Long anchor ids and 'jumptosection' links are fixed up first, on the
+    same parsed tree that is converted
+    """
+    docx_io = html_to_docx(_prepare_tree(html))
+    with open(out_path, "wb") as docx_file:
+        docx_file.write(docx_io.getbuffer())
+
+
+def main() -> None:
+    """
+    Command line entry point, converts an html file to a docx file
+    """
+    parser = argparse.ArgumentParser(description="Convert an html file to docx")
+    parser.add_argument("html_file", help="path of the html file to convert")
+    parser.add_argument(
+        "docx_file",
+        nargs="?",
+        help="path of the docx file to write, defaults to html_file with .docx",
+    )
+    args = parser.parse_args()
+    out_path = args.docx_file or str(Path(args.html_file).with_suffix(".docx"))
+    convert(parse_html_file(args.html_file), out_path)
+
+
+if __name__ == "__main__":
+    main()
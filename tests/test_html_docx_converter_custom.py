@@ -0,0 +1,166 @@
+import unittest
+
+from docx import Document
+from docx.oxml.ns import qn
+
+import html_docx_converter_custom
+from html_docx_converter_custom import html_to_docx
+
+try:
+    import re2
+except ImportError:
+    re2 = None
+
+
+def convert_body(body: str) -> Document:
+    """Convert an html body and open the result as a docx Document"""
+    html = f"<html><head><title>Test</title></head><body>{body}</body></html>"
+    return Document(html_to_docx(html))
+
+
+def paragraphs(doc: Document) -> list[tuple[str, str]]:
+    """(style name, text) of the document paragraphs, without the title"""
+    return [(p.style.name, p.text) for p in doc.paragraphs[1:]]
+
+
+def cell_texts(doc: Document) -> list[str]:
+    """Non empty paragraph texts of the first table cell"""
+    cell = doc.tables[0].rows[0].cells[0]
+    return [p.text for p in cell.paragraphs if p.text]
+
+
+def local_name(element) -> str:
+    """Tag name of an xml element without its namespace"""
+    return element.tag.rsplit("}", 1)[-1]
+
+
+def paragraph_parts(paragraph) -> list[tuple[str, str]]:
+    """(kind, text) of the runs, bookmarks, breaks and links of a paragraph"""
+    parts = []
+    for element in paragraph._p.iterchildren():
+        text = "".join(t.text for t in element.iter(qn("w:t")))
+        bookmark = element.find(qn("w:bookmarkStart"))
+        if local_name(element) == "hyperlink":
+            parts.append(("link", text))
+        elif bookmark is not None:
+            parts.append(("bookmark", bookmark.get(qn("w:name"))))
+        elif element.find(qn("w:br")) is not None and not text:
+            parts.append(("br", ""))
+        elif local_name(element) == "r":
+            parts.append(("text", text))
+    return parts
+
+
+class RunXmlTests(unittest.TestCase):
+    def test_tabs_and_line_feeds(self):
+        doc = convert_body("<p>a\tb\nc</p>")
+        run = doc.paragraphs[1].runs[0]._r
+        children = [local_name(child) for child in run]
+        self.assertEqual(children, ["t", "tab", "t", "br", "t"])
+
+    def test_leading_and_trailing_spaces_are_preserved(self):
+        doc = convert_body("<p><b> a </b>b</p>")
+        spaces = [
+            t.get("{http://www.w3.org/XML/1998/namespace}space")
+            for t in doc.paragraphs[1]._p.iter(qn("w:t"))
+        ]
+        self.assertEqual(spaces, ["preserve", None])
+        self.assertEqual(doc.paragraphs[1].text, " a b")
+
+    def test_special_characters_are_escaped(self):
+        doc = convert_body("<p>a &amp; &lt;b&gt;</p>")
+        self.assertEqual(doc.paragraphs[1].text, "a & <b>")
+
+    def test_bookmarks_links_and_breaks_keep_their_order(self):
+        doc = convert_body(
+            '<p>one<span class="anchor" id="x"></span><b>two</b><br>'
+            'three <a href="https://e.com">link</a> four</p>'
+        )
+        self.assertEqual(
+            paragraph_parts(doc.paragraphs[1]),
+            [
+                ("text", "one"),
+                ("bookmark", "x"),
+                ("text", "two"),
+                ("br", ""),
+                ("text", "three "),
+                ("link", "link"),
+                ("text", " four"),
+            ],
+        )
+
+
+class NestedBlockTests(unittest.TestCase):
+    def test_heading_in_list_item(self):
+        doc = convert_body("<ul><li><h3>X</h3></li></ul>")
+        self.assertEqual(paragraphs(doc), [("Heading 3", "X")])
+
+    def test_text_list_item(self):
+        doc = convert_body("<ul><li>plain</li></ul>")
+        self.assertEqual(paragraphs(doc), [("List Bullet", "plain")])
+
+    def test_text_and_inline_tags_share_list_paragraph(self):
+        doc = convert_body("<ul><li>a <b>b</b> c</li></ul>")
+        self.assertEqual(paragraphs(doc), [("List Bullet", "a b c")])
+        self.assertEqual(
+            [run.bold for run in doc.paragraphs[1].runs], [None, True, None]
+        )
+
+    def test_div_paragraph_in_list_item(self):
+        doc = convert_body("<ul><li><div><p>X</p></div></li></ul>")
+        self.assertEqual(paragraphs(doc), [("List Bullet", "X")])
+
+    def test_div_paragraph_in_table_cell(self):
+        doc = convert_body("<table><tr><td><div><p>X</p></div></td></tr></table>")
+        self.assertEqual(cell_texts(doc), ["X"])
+
+    def test_link_in_bold_list_item(self):
+        doc = convert_body('<ul><li><b><a href="https://e.com">L</a></b></li></ul>')
+        self.assertEqual(paragraphs(doc), [("List Bullet", "L")])
+        self.assertEqual(doc.paragraphs[1].hyperlinks[0].url, "https://e.com")
+
+
+class WhitespaceTests(unittest.TestCase):
+    def test_indented_blockquote(self):
+        doc = convert_body("<blockquote>\n  <p>one</p>\n  <p>two</p>\n</blockquote>")
+        self.assertEqual(paragraphs(doc), [("Normal", "one"), ("Normal", "two")])
+
+    def test_indented_table_cell(self):
+        doc = convert_body("<table><tr><td>\n  <p>c</p>\n</td></tr></table>")
+        cell = doc.tables[0].rows[0].cells[0]
+        runs = [run.text for p in cell.paragraphs for run in p.runs]
+        self.assertEqual(runs, ["c"])
+
+    def test_space_between_inline_tags(self):
+        doc = convert_body("<table><tr><td><b>a</b> <i>b</i></td></tr></table>")
+        self.assertEqual(cell_texts(doc), ["a b"])
+
+
+class ParseTests(unittest.TestCase):
+    def test_xhtml_string_with_declaration(self):
+        html = (
+            '\ufeff<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<html xmlns="http://www.w3.org/1999/xhtml"><body><p>X</p></body></html>'
+        )
+        root = html_docx_converter_custom.parse_html(html)
+        self.assertEqual(root.body.text_content(), "X")
+
+
+@unittest.skipIf(re2 is None, "google-re2 is not installed")
+class Re2Tests(unittest.TestCase):
+    def test_module_patterns_compile(self):
+        # The module switches to re2 when it is installed, its patterns must
+        # not use syntax only the re module supports
+        patterns = {
+            name: value
+            for name, value in vars(html_docx_converter_custom).items()
+            if name.endswith("_RE")
+        }
+        self.assertTrue(patterns)
+        for name, pattern in patterns.items():
+            with self.subTest(name):
+                re2.compile(pattern.pattern)
+
+
+if __name__ == "__main__":
+    unittest.main()